@@ -4,36 +4,37 @@ Kokoro TTS API Server - Optimized for Single Voice (af_heart)
 Lightweight server with minimal resource usage
 """
 
-from flask import Flask, request, jsonify, send_file
+# Imported first: it sizes the torch thread pools before torch loads
+from tts_engine import (
+    CACHE_MAX_TEXT_LENGTH, MAX_TEXT_LENGTH, batch_worker, configure_torch,
+    current_timestamp, generate_wav_stream, new_request_id, optimize_pipeline,
+    share_memory, use_orjson, wav_cache
+)
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from kokoro import KPipeline
-import soundfile as sf
-import torch
-import io
-import tempfile
-import uuid
 import warnings
-from datetime import datetime
-import numpy as np
 
 # Suppress warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 app = Flask(__name__)
 CORS(app)
+use_orjson(app)
 
 # Single pipeline for optimized performance
 pipeline = None
 VOICE = 'af_heart'
+voice_pack = None  # VOICE's style tensor, loaded once at startup
 
 def initialize_pipeline():
     """Initialize single Kokoro pipeline for British accent"""
-    global pipeline
+    global pipeline, voice_pack
     
     print("🔄 Initializing Kokoro pipeline...")
     
     # Force CPU usage
-    torch.set_default_device('cpu')
+    configure_torch()
     
     try:
         print(f"  🔄 Loading British English pipeline with {VOICE} voice...")
@@ -41,12 +42,37 @@ def initialize_pipeline():
             lang_code='b',  # British English only
             repo_id='hexgrad/Kokoro-82M'
         )
+        optimize_pipeline(pipeline, VOICE)
+        voice_pack = pipeline.load_voice(VOICE)
+        share_memory(pipeline.model, voice_pack)
         print(f"  ✅ Pipeline ready with {VOICE} voice!")
         return True
     except Exception as e:
         print(f"  ❌ Failed to load pipeline: {e}")
         return False
 
+def parse_tts_request():
+    """Parse and validate a TTS request body, returning (text, speed, error)"""
+    data = request.get_json(silent=True)
+    
+    if not isinstance(data, dict) or 'text' not in data:
+        return None, None, 'Missing text parameter'
+    
+    text = data['text']
+    speed = data.get('speed', 1.0)
+    
+    if not isinstance(text, str) or not text or text.isspace():
+        return None, None, 'Text cannot be empty'
+    
+    if len(text) > MAX_TEXT_LENGTH:
+        return None, None, f'Text too long (max {MAX_TEXT_LENGTH} characters)'
+    
+    # bool is an int subclass, and the negated range test also rejects NaN
+    if isinstance(speed, bool) or not isinstance(speed, (int, float)) or not 0.5 <= speed <= 2.0:
+        return None, None, 'Speed must be a number between 0.5 and 2.0'
+    
+    return text, speed, None
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -56,7 +82,7 @@ def health_check():
         'voice': VOICE,
         'accent': 'british',
         'device': 'CPU',
-        'timestamp': datetime.now().isoformat()
+        'timestamp': current_timestamp()
     })
 
 @app.route('/voice', methods=['GET'])
@@ -70,6 +96,16 @@ def get_voice_info():
         'type': 'female'
     })
 
+@app.route('/status', methods=['GET'])
+def get_status():
+    """Synthesis queue status"""
+    return jsonify(batch_worker.status())
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """WAV cache statistics"""
+    return jsonify({**wav_cache.stats(), 'max_text_length': CACHE_MAX_TEXT_LENGTH})
+
 @app.route('/tts', methods=['POST'])
 def text_to_speech():
     """Convert text to speech with af_heart voice"""
@@ -77,54 +113,27 @@ def text_to_speech():
         if not pipeline:
             return jsonify({'error': 'TTS pipeline not initialized'}), 500
         
-        # Get request data
-        data = request.get_json()
-        
-        if not data or 'text' not in data:
-            return jsonify({'error': 'Missing text parameter'}), 400
-        
-        text = data['text']
-        speed = data.get('speed', 1.0)
-        
-        # Validate parameters
-        if not text.strip():
-            return jsonify({'error': 'Text cannot be empty'}), 400
-        
-        if len(text) > 5000:
-            return jsonify({'error': 'Text too long (max 5000 characters)'}), 400
-        
-        if speed < 0.5 or speed > 2.0:
-            return jsonify({'error': 'Speed must be between 0.5 and 2.0'}), 400
+        text, speed, error = parse_tts_request()
+        if error:
+            return jsonify({'error': error}), 400
         
         print(f"🎤 Generating speech: voice={VOICE}, speed={speed}")
         
-        # Generate audio
-        generator = pipeline(text, voice=VOICE, speed=speed)
-        
-        # Collect all audio segments
-        audio_segments = []
-        for i, (gs, ps, audio) in enumerate(generator):
-            audio_segments.append(audio)
-        
-        if not audio_segments:
-            return jsonify({'error': 'No audio generated'}), 500
-        
-        # Concatenate audio segments
-        if len(audio_segments) == 1:
-            final_audio = audio_segments[0]
-        else:
-            final_audio = np.concatenate(audio_segments)
+        headers = {
+            'Content-Disposition': f'attachment; filename=kokoro_{VOICE}_{new_request_id()}.wav'
+        }
         
-        # Create temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        sf.write(temp_file.name, final_audio, 24000)
+        # Repeated short texts are served whole from the cache
+        cache_key = (text, speed) if len(text) <= CACHE_MAX_TEXT_LENGTH else None
+        wav = wav_cache.get(cache_key) if cache_key else None
+        if wav:
+            return Response(wav, mimetype='audio/wav', headers=headers)
         
-        # Return audio file
-        return send_file(
-            temp_file.name,
+        # Otherwise stream the audio back as it is generated
+        return Response(
+            stream_with_context(generate_wav_stream(pipeline, text, voice_pack, speed, cache_key)),
             mimetype='audio/wav',
-            as_attachment=True,
-            download_name=f'kokoro_{VOICE}_{uuid.uuid4().hex[:8]}.wav'
+            headers=headers
         )
         
     except Exception as e:
@@ -139,6 +148,8 @@ if __name__ == '__main__':
         print("\n📡 API Endpoints:")
         print("  GET  /health      - Health check")
         print("  GET  /voice       - Voice information")
+        print("  GET  /status      - Synthesis queue status")
+        print("  GET  /cache_stats - WAV cache statistics")
         print("  POST /tts         - Generate speech (WAV file)")
         print("  POST /tts_base64  - Generate speech (base64)")
         print("  GET  /demo        - Web demo page")
@@ -146,8 +157,9 @@ if __name__ == '__main__':
         print("\n🌐 Starting server on http://localhost:5001")
         print("💡 Visit http://localhost:5001/demo for the web interface")
         print("⚡ Optimized for single voice - reduced memory usage!")
+        print("🏭 For production: gunicorn -w 1 --threads 8 -k gthread -b 0.0.0.0:5001 wsgi:application")
         
-        app.run(host='0.0.0.0', port=5001, debug=False)
+        app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
     else:
         print("❌ Failed to initialize pipeline. Exiting.")
         exit(1)
\ No newline at end of file
@@ -4,87 +4,216 @@ Kokoro British Accent TTS API Server
 Provides REST API endpoints for text-to-speech with British accent
 """
 
-from flask import Flask, request, jsonify, send_file
+# Imported first: it sizes the torch thread pools before torch loads
+from tts_engine import (
+    CACHE_MAX_TEXT_LENGTH, MAX_TEXT_LENGTH, batch_worker, configure_torch,
+    current_timestamp, generate_wav_stream, new_request_id, optimize_pipeline,
+    render_wav, share_memory, use_orjson, wav_cache
+)
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from kokoro import KPipeline
-import soundfile as sf
-import torch
-import io
+from kokoro import KModel, KPipeline
+import binascii
 import os
-import tempfile
-import uuid
+import threading
+import time
 import warnings
-from datetime import datetime
-import numpy as np
 
 # Suppress warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 app = Flask(__name__)
 CORS(app)
+use_orjson(app)
 
-# Global pipeline instances for different languages
-pipelines = {}
+# Supported accents; pipelines are loaded on first use
+ACCENT_CONFIGS = {
+    'british': {'lang_code': 'b', 'name': 'British English'},
+    'american': {'lang_code': 'a', 'name': 'American English'},
+    'spanish': {'lang_code': 'e', 'name': 'Spanish'},
+    'french': {'lang_code': 'f', 'name': 'French'},
+    'italian': {'lang_code': 'i', 'name': 'Italian'},
+}
+DEFAULT_ACCENT = 'british'
 
-def initialize_pipelines():
-    """Initialize Kokoro pipelines for different accents"""
-    print("🔄 Initializing Kokoro pipelines...")
+# Extra accents to load in the background at startup, e.g. "american,french"
+PRELOAD_ACCENTS = [a for a in os.environ.get('KOKORO_PRELOAD_ACCENTS', '').split(',') if a]
+
+# After a failed load (e.g. a model download error), wait this long before retrying
+LOAD_RETRY_SECONDS = 30
+
+class PipelineLoadError(RuntimeError):
+    """A configured accent's pipeline failed to load and is waiting to be retried"""
+
+class PipelineRegistry:
+    """Thread-safe registry that loads accent pipelines on first use"""
     
-    # Force CPU usage
-    torch.set_default_device('cpu')
+    def __init__(self, configs):
+        self.configs = configs
+        self.pipelines = {}
+        # Accents whose last load failed: (error, monotonic time of the next retry)
+        self.failures = {}
+        self.lock = threading.Lock()
+        # Shared across accents: only G2P differs per language
+        self.model = None
+        self.voices = {}
     
-    # Initialize pipelines for different accents
-    accent_configs = {
-        'british': {'lang_code': 'b', 'name': 'British English'},
-        'american': {'lang_code': 'a', 'name': 'American English'},
-        'spanish': {'lang_code': 'e', 'name': 'Spanish'},
-        'french': {'lang_code': 'f', 'name': 'French'},
-        'italian': {'lang_code': 'i', 'name': 'Italian'},
-    }
+    def __contains__(self, accent):
+        return accent in self.configs
+    
+    def available(self):
+        return list(self.configs.keys())
+    
+    def loaded(self):
+        return list(self.pipelines.keys())
+    
+    def failed(self):
+        return {accent: error for accent, (error, _) in self.failures.items()}
     
-    for accent, config in accent_configs.items():
+    def get(self, accent):
+        pipeline = self.pipelines.get(accent)
+        if pipeline is None:
+            with self.lock:
+                # Another request may have loaded (or failed to load) it while we waited
+                pipeline = self.pipelines.get(accent)
+                if pipeline is None:
+                    error, retry_at = self.failures.get(accent, (None, 0))
+                    if time.monotonic() < retry_at:
+                        raise PipelineLoadError(f'{accent} pipeline failed to load: {error}')
+                    try:
+                        pipeline = self.load(accent)
+                    except Exception as e:
+                        self.failures[accent] = (str(e), time.monotonic() + LOAD_RETRY_SECONDS)
+                        raise PipelineLoadError(f'{accent} pipeline failed to load: {e}') from e
+                    self.failures.pop(accent, None)
+                    self.pipelines[accent] = pipeline
+        return pipeline
+    
+    def load(self, accent):
+        config = self.configs[accent]
+        print(f"  🔄 Loading {config['name']} pipeline...")
+        pipeline = KPipeline(
+            lang_code=config['lang_code'],
+            repo_id='hexgrad/Kokoro-82M',  # Suppress repo_id warning
+            model=False  # G2P only; the model is attached below
+        )
+        pipeline.voices = self.voices
+        
+        if self.model is None:
+            # First accent loads, optimizes and warms up the model for all
+            pipeline.model = KModel(repo_id='hexgrad/Kokoro-82M').to('cpu').eval()
+            optimize_pipeline(pipeline, 'af_heart')
+            share_memory(pipeline.model)
+            self.model = pipeline.model
+        else:
+            pipeline.model = self.model
+        print(f"  ✅ {config['name']} pipeline ready!")
+        return pipeline
+
+pipelines = PipelineRegistry(ACCENT_CONFIGS)
+
+def preload_accents(accents):
+    """Load pipelines in the background so their first request is fast"""
+    for accent in accents:
         try:
-            print(f"  🔄 Loading {config['name']} pipeline...")
-            pipelines[accent] = KPipeline(
-                lang_code=config['lang_code'],
-                repo_id='hexgrad/Kokoro-82M'  # Suppress repo_id warning
-            )
-            print(f"  ✅ {config['name']} pipeline ready!")
+            pipelines.get(accent)
         except Exception as e:
-            print(f"  ❌ Failed to load {config['name']}: {e}")
+            print(f"  ❌ Failed to preload {accent}: {e}")
+
+def initialize_pipelines(background=True):
+    """Initialize the default Kokoro pipeline; other accents load on demand"""
+    print("🔄 Initializing Kokoro pipelines...")
+    
+    # Force CPU usage
+    configure_torch()
+    
+    try:
+        pipelines.get(DEFAULT_ACCENT)
+    except Exception as e:
+        print(f"  ❌ Failed to load {ACCENT_CONFIGS[DEFAULT_ACCENT]['name']}: {e}")
+    
+    accents = [a for a in PRELOAD_ACCENTS if a in pipelines and a != DEFAULT_ACCENT]
+    # No thread may be running (or holding the registry lock) when a
+    # preloading server forks its workers, so wsgi loads these inline
+    if accents and not background:
+        preload_accents(accents)
+    elif accents:
+        threading.Thread(target=preload_accents, args=(accents,), name='tts-preload', daemon=True).start()
+    
+    print(f"✅ {len(pipelines.loaded())} pipelines initialized, others load on first use")
+
+def synthesize_wav(text, accent, voice, speed):
+    """Return WAV bytes for the text, serving short texts from the LRU cache"""
+    if len(text) > CACHE_MAX_TEXT_LENGTH:
+        return render_wav(pipelines.get(accent), text, voice, speed)
+    cache_key = (text, accent, voice, speed)
+    wav = wav_cache.get(cache_key)
+    if wav is None:
+        wav = render_wav(pipelines.get(accent), text, voice, speed)
+        wav_cache.put(cache_key, wav)
+    return wav
+
+def parse_tts_request():
+    """Parse and validate a TTS request body, returning (text, accent, voice, speed, error)"""
+    data = request.get_json(silent=True)
+    
+    if not isinstance(data, dict) or 'text' not in data:
+        return None, None, None, None, 'Missing text parameter'
+    
+    text = data['text']
+    accent = data.get('accent', DEFAULT_ACCENT)
+    voice = data.get('voice', 'af_heart')
+    speed = data.get('speed', 1.0)
+    
+    if not isinstance(text, str) or not text or text.isspace():
+        return None, None, None, None, 'Text cannot be empty'
+    
+    if len(text) > MAX_TEXT_LENGTH:
+        return None, None, None, None, f'Text too long (max {MAX_TEXT_LENGTH} characters)'
+    
+    if not isinstance(accent, str) or accent not in pipelines:
+        return None, None, None, None, f'Accent "{accent}" not available. Available: {pipelines.available()}'
+    
+    if not isinstance(voice, str) or not voice:
+        return None, None, None, None, 'Voice must be a non-empty string'
+    
+    # bool is an int subclass, and the negated range test also rejects NaN
+    if isinstance(speed, bool) or not isinstance(speed, (int, float)) or not 0.5 <= speed <= 2.0:
+        return None, None, None, None, 'Speed must be a number between 0.5 and 2.0'
     
-    print(f"✅ {len(pipelines)} pipelines initialized successfully!")
+    return text, accent, voice, speed, None
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
-        'status': 'healthy',
+        'status': 'healthy' if DEFAULT_ACCENT in pipelines.loaded() else 'error',
         'model': 'Kokoro-82M',
         'device': 'CPU',
-        'available_accents': list(pipelines.keys()),
-        'timestamp': datetime.now().isoformat()
+        'available_accents': pipelines.available(),
+        'loaded_accents': pipelines.loaded(),
+        'failed_accents': pipelines.failed(),
+        'timestamp': current_timestamp()
     })
 
 @app.route('/accents', methods=['GET'])
 def get_accents():
     """Get available accents"""
-    accent_info = {
-        'british': {'name': 'British English', 'lang_code': 'b'},
-        'american': {'name': 'American English', 'lang_code': 'a'},
-        'spanish': {'name': 'Spanish', 'lang_code': 'e'},
-        'french': {'name': 'French', 'lang_code': 'f'},
-        'italian': {'name': 'Italian', 'lang_code': 'i'},
-    }
-    
     available_accents = {}
-    for accent in pipelines.keys():
-        if accent in accent_info:
-            available_accents[accent] = accent_info[accent]
+    loaded = pipelines.loaded()
+    failed = pipelines.failed()
+    for accent, config in ACCENT_CONFIGS.items():
+        available_accents[accent] = {
+            'name': config['name'],
+            'lang_code': config['lang_code'],
+            'loaded': accent in loaded
+        }
+        if accent in failed:
+            available_accents[accent]['error'] = failed[accent]
     
     return jsonify({
         'accents': available_accents,
-        'default': 'british'
+        'default': DEFAULT_ACCENT
     })
 
 @app.route('/voices', methods=['GET'])
@@ -101,131 +230,72 @@ def get_voices():
         'note': 'All voices work with all accents'
     })
 
+@app.route('/status', methods=['GET'])
+def get_status():
+    """Synthesis queue status"""
+    return jsonify(batch_worker.status())
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """WAV cache statistics"""
+    return jsonify({**wav_cache.stats(), 'max_text_length': CACHE_MAX_TEXT_LENGTH})
+
 @app.route('/tts', methods=['POST'])
 def text_to_speech():
     """Convert text to speech with British accent (default)"""
     try:
-        # Get request data
-        data = request.get_json()
-        
-        if not data or 'text' not in data:
-            return jsonify({'error': 'Missing text parameter'}), 400
-        
-        text = data['text']
-        accent = data.get('accent', 'british')  # Default to British
-        voice = data.get('voice', 'af_heart')
-        speed = data.get('speed', 1.0)
-        
-        # Validate parameters
-        if not text.strip():
-            return jsonify({'error': 'Text cannot be empty'}), 400
-        
-        if len(text) > 5000:
-            return jsonify({'error': 'Text too long (max 5000 characters)'}), 400
+        text, accent, voice, speed, error = parse_tts_request()
+        if error:
+            return jsonify({'error': error}), 400
         
-        if accent not in pipelines:
-            return jsonify({'error': f'Accent "{accent}" not available. Available: {list(pipelines.keys())}'}), 400
+        headers = {
+            'Content-Disposition': f'attachment; filename=kokoro_{accent}_{new_request_id()}.wav'
+        }
         
-        # Get the appropriate pipeline
-        pipeline = pipelines[accent]
+        # Repeated short texts are served whole from the cache
+        cache_key = (text, accent, voice, speed) if len(text) <= CACHE_MAX_TEXT_LENGTH else None
+        wav = wav_cache.get(cache_key) if cache_key else None
+        if wav:
+            return Response(wav, mimetype='audio/wav', headers=headers)
         
-        # Generate audio
-        generator = pipeline(text, voice=voice, speed=speed)
-        
-        # Collect all audio segments
-        audio_segments = []
-        for i, (gs, ps, audio) in enumerate(generator):
-            audio_segments.append(audio)
-        
-        if not audio_segments:
-            return jsonify({'error': 'No audio generated'}), 500
-        
-        # Concatenate audio segments
-        if len(audio_segments) == 1:
-            final_audio = audio_segments[0]
-        else:
-            final_audio = np.concatenate(audio_segments)
-        
-        # Create temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        sf.write(temp_file.name, final_audio, 24000)
-        
-        # Return audio file
-        return send_file(
-            temp_file.name,
+        # Otherwise stream the audio back as it is generated
+        return Response(
+            stream_with_context(generate_wav_stream(pipelines.get(accent), text, voice, speed, cache_key)),
             mimetype='audio/wav',
-            as_attachment=True,
-            download_name=f'kokoro_{accent}_{uuid.uuid4().hex[:8]}.wav'
+            headers=headers
         )
         
+    except PipelineLoadError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/tts/british', methods=['POST'])
 def british_tts():
     """Dedicated British accent TTS endpoint"""
-    try:
-        data = request.get_json()
-        if not data:
-            data = {}
-        
-        # Force British accent
+    # get_json caches the parsed body, so parse_tts_request sees this dict
+    data = request.get_json(silent=True)
+    
+    # Force British accent; anything that isn't a JSON object gets text_to_speech's 400
+    if isinstance(data, dict):
         data['accent'] = 'british'
-        
-        # Use the main TTS function
-        request.json = data
-        return text_to_speech()
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    
+    # Use the main TTS function
+    return text_to_speech()
 
 @app.route('/tts_base64', methods=['POST'])
 def text_to_speech_base64():
     """Convert text to speech and return base64 encoded audio"""
     try:
-        data = request.get_json()
-        
-        if not data or 'text' not in data:
-            return jsonify({'error': 'Missing text parameter'}), 400
-        
-        text = data['text']
-        accent = data.get('accent', 'british')
-        voice = data.get('voice', 'af_heart')
-        speed = data.get('speed', 1.0)
-        
-        # Validate parameters
-        if not text.strip():
-            return jsonify({'error': 'Text cannot be empty'}), 400
-        
-        if accent not in pipelines:
-            return jsonify({'error': f'Accent "{accent}" not available'}), 400
-        
-        # Get the appropriate pipeline
-        pipeline = pipelines[accent]
+        text, accent, voice, speed, error = parse_tts_request()
+        if error:
+            return jsonify({'error': error}), 400
         
         # Generate audio
-        generator = pipeline(text, voice=voice, speed=speed)
-        
-        # Collect all audio segments
-        audio_segments = []
-        for i, (gs, ps, audio) in enumerate(generator):
-            audio_segments.append(audio)
-        
-        if not audio_segments:
-            return jsonify({'error': 'No audio generated'}), 500
-        
-        # Concatenate audio segments
-        if len(audio_segments) == 1:
-            final_audio = audio_segments[0]
-        else:
-            final_audio = np.concatenate(audio_segments)
+        wav_bytes = synthesize_wav(text, accent, voice, speed)
         
         # Convert to base64
-        import base64
-        audio_buffer = io.BytesIO()
-        sf.write(audio_buffer, final_audio, 24000, format='WAV')
-        audio_buffer.seek(0)
-        audio_base64 = base64.b64encode(audio_buffer.read()).decode('utf-8')
+        audio_base64 = binascii.b2a_base64(wav_bytes, newline=False).decode('ascii')
         
         return jsonify({
             'audio_base64': audio_base64,
@@ -236,6 +306,8 @@ def text_to_speech_base64():
             'format': 'wav'
         })
         
+    except PipelineLoadError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -363,6 +435,8 @@ if __name__ == '__main__':
     print("  GET  /health       - Health check")
     print("  GET  /accents      - Available accents")
     print("  GET  /voices       - Available voices")
+    print("  GET  /status       - Synthesis queue status")
+    print("  GET  /cache_stats  - WAV cache statistics")
     print("  POST /tts          - Generate speech (default: British)")
     print("  POST /tts/british  - British accent TTS")
     print("  POST /tts_base64   - Generate speech (base64)")
@@ -370,5 +444,6 @@ if __name__ == '__main__':
     
     print("\n🌐 Starting server on http://localhost:5000")
     print("💡 Visit http://localhost:5000/demo for a web interface")
+    print("🏭 For production: KOKORO_SERVER=multi gunicorn -w 1 --threads 8 -k gthread -b 0.0.0.0:5001 wsgi:application")
     
-    app.run(host='0.0.0.0', port=5001, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
\ No newline at end of file
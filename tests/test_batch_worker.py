@@ -0,0 +1,116 @@
+"""
+Scheduler regression tests for the shared TTS engine, using a stub G2P pipeline
+"""
+
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tts_engine
+except ImportError as e:  # torch, kokoro, flask and numpy are needed to import the engine
+    raise unittest.SkipTest(f'TTS engine dependencies not installed: {e}')
+
+TIMEOUT = 5
+
+class StubResult:
+    def __init__(self, phonemes):
+        self.phonemes = phonemes
+
+class StubPipeline:
+    """Phonemizes one word per chunk, slowly enough for G2P to lag the worker"""
+    model = None
+
+    def __call__(self, text, split_pattern=None):
+        for word in text.split():
+            time.sleep(0.001)
+            yield StubResult(word)
+
+def stub_segments(text):
+    """Segment generator that passes phonemes through in place of audio"""
+    yield from tts_engine.prefetch_phonemes(StubPipeline(), text)
+
+def drain(job):
+    """Read a job to the end on another thread; returns its segments or None on timeout"""
+    segments, error = drain_with_error(job)
+    return None if error is not None else segments
+
+def drain_with_error(job):
+    """Read a job on another thread; returns (segments, exception) with a TimeoutError if it hangs"""
+    segments = []
+    errors = []
+    
+    def read():
+        try:
+            segments.extend(job)
+        except Exception as e:
+            errors.append(e)
+    
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    reader.join(TIMEOUT)
+    if reader.is_alive():
+        return segments, TimeoutError('job never finished')
+    return segments, errors[0] if errors else None
+
+class BatchWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        # A G2P pool no larger than the batch, as in production
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        tts_engine.g2p_executor = self.executor
+        tts_engine.g2p_executor_pid = os.getpid()
+        self.worker = tts_engine.BatchWorker(2)
+
+    def tearDown(self):
+        tts_engine.g2p_executor = None
+        self.executor.shutdown(wait=False)
+
+    def wait_for_held(self, count):
+        deadline = time.monotonic() + TIMEOUT
+        while self.worker.status()['held_jobs'] < count:
+            self.assertLess(time.monotonic(), deadline, 'jobs were never held')
+            time.sleep(0.01)
+
+    def test_held_jobs_do_not_stall_new_requests(self):
+        long_text = ' '.join(['word'] * 50)
+        stalled = [self.worker.submit(stub_segments(long_text)) for _ in range(2)]
+        self.wait_for_held(2)
+
+        self.assertEqual(drain(self.worker.submit(stub_segments('a b c'))), ['a', 'b', 'c'])
+
+        # Held jobs resume once their clients start reading
+        for job in stalled:
+            self.assertEqual(drain(job), ['word'] * 50)
+
+    def test_errors_reach_the_client(self):
+        def failing():
+            yield from stub_segments('a b')
+            raise RuntimeError('model failed')
+
+        job = self.worker.submit(failing())
+        with self.assertRaisesRegex(RuntimeError, 'model failed'):
+            list(job)
+
+    def test_worker_failure_fails_jobs_and_recovers(self):
+        def close_fails():
+            try:
+                yield from stub_segments(' '.join(['word'] * 50))
+            finally:
+                raise RuntimeError('close failed')
+
+        waiting = self.worker.submit(stub_segments(' '.join(['word'] * 50)))
+        failing = self.worker.submit(close_fails())
+        # The client disconnects, so the worker closes its segments and fails
+        reader = iter(failing)
+        next(reader)
+        reader.close()
+
+        _, error = drain_with_error(waiting)
+        self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(drain(self.worker.submit(stub_segments('a b'))), ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
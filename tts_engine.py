@@ -0,0 +1,647 @@
+"""
+Kokoro TTS synthesis engine shared by the API servers
+CPU thread setup, model optimization, request scheduling and WAV encoding
+"""
+
+import os
+
+def parse_cpu_list(text):
+    """Parse a sysfs CPU list such as '0-3,8' into a set of CPU ids"""
+    cpus = set()
+    for part in text.strip().split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def one_cpu_per_core(cpu_ids):
+    """Pick the first usable logical CPU of each physical core, or None if the topology is unreadable"""
+    chosen = []
+    seen_cores = set()
+    for cpu in cpu_ids:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list') as f:
+                siblings = frozenset(parse_cpu_list(f.read()))
+        except (OSError, ValueError):
+            return None
+        if siblings not in seen_cores:
+            seen_cores.add(siblings)
+            chosen.append(cpu)
+    return chosen
+
+def env_thread_count(name):
+    """Thread count from an environment variable, or None if it is unset or not a positive integer"""
+    value = os.environ.get(name, '').strip()
+    if not value:
+        return None
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    print(f"⚠️ Ignoring {name}={value!r}: expected a positive integer")
+    return None
+
+# Size the OpenMP/MKL pools before torch is imported (kokoro imports it):
+# one thread per physical core, minus one core that is left to the HTTP
+# threads. KOKORO_THREADS, or else an explicit OMP_NUM_THREADS, overrides
+# this. Cores are read from the sysfs topology; if it is unavailable every
+# usable CPU is counted as a core
+CPU_IDS = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+CORE_CPU_IDS = one_cpu_per_core(CPU_IDS)
+PHYSICAL_CORES = len(CORE_CPU_IDS) if CORE_CPU_IDS else len(CPU_IDS)
+TORCH_THREADS = (
+    env_thread_count('KOKORO_THREADS')
+    or env_thread_count('OMP_NUM_THREADS')
+    or max(1, PHYSICAL_CORES - 1)
+)
+os.environ.setdefault('OMP_NUM_THREADS', str(TORCH_THREADS))
+os.environ.setdefault('MKL_NUM_THREADS', str(TORCH_THREADS))
+os.environ.setdefault('MKL_DYNAMIC', 'FALSE')
+
+# Keep to one logical CPU per core so sibling hyperthreads don't contend
+# (set KOKORO_PIN_CPUS=1 to enable); skipped unless SMT siblings were detected
+if (os.environ.get('KOKORO_PIN_CPUS', '0') == '1' and hasattr(os, 'sched_setaffinity')
+        and CORE_CPU_IDS and len(CORE_CPU_IDS) < len(CPU_IDS)):
+    os.sched_setaffinity(0, CORE_CPU_IDS)
+
+from flask.json.provider import DefaultJSONProvider
+from kokoro import KPipeline
+import torch
+import collections
+import copy
+import itertools
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Compile the model's token-level forward pass at startup (set KOKORO_COMPILE=1
+# to enable); KModel.forward takes a phoneme string, so only the tensor part is compiled
+USE_COMPILE = os.environ.get('KOKORO_COMPILE', '0') == '1'
+WARMUP_TEXT = 'Warming up the speech model.'
+
+# Serve the model through ONNX Runtime: KOKORO_ONNX=/path/to/kokoro.onnx
+# (exported on first start if missing); replaces int8 and torch.compile
+ONNX_MODEL_PATH = os.environ.get('KOKORO_ONNX', '')
+
+# Quantize Linear/LSTM layers to int8 (set KOKORO_INT8=1 to enable)
+USE_INT8 = os.environ.get('KOKORO_INT8', '0') == '1'
+
+def bf16_supported():
+    """Whether oneDNN has native bf16 kernels on this CPU (AVX512-BF16/AMX)"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+# Run inference under bf16 autocast where the CPU supports it natively (set
+# KOKORO_BF16=0 to keep FP32); elsewhere bf16 is emulated and slower than FP32.
+# Dynamically quantized layers expect FP32 activations, so int8 disables it
+USE_BF16 = os.environ.get('KOKORO_BF16', '1') == '1' and not USE_INT8 and bf16_supported()
+
+# Cross-request scheduling: at most this many requests are synthesized at once
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '8'))
+
+# Synthesize sentence by sentence, holding at most this many generated but
+# unsent segments per request, so memory stays flat for long inputs
+SENTENCE_SPLIT_PATTERN = r'\n+|(?<=[.!?])\s+'
+MAX_INFLIGHT_SEGMENTS = 10
+
+# Phonemization (G2P) runs on a thread pool, ahead of model inference. A job
+# whose next phonemes are not ready yields SEGMENT_NOT_READY after a short
+# poll, so the batch worker never blocks on a single job
+G2P_POLL_SECONDS = 0.01
+SEGMENT_NOT_READY = object()
+g2p_executor = None
+g2p_executor_pid = None
+g2p_executor_lock = threading.Lock()
+g2p_lock = threading.Lock()
+
+# Copy the weights into shared memory after loading (set KOKORO_SHARE_MEMORY=1
+# to enable); needs /dev/shm room for the whole model, which Docker's 64 MB
+# default does not have
+USE_SHARED_MEMORY = os.environ.get('KOKORO_SHARE_MEMORY', '0') == '1'
+
+# Longest accepted input text
+MAX_TEXT_LENGTH = 5000
+
+# Repeated short texts (FAQ answers, demo phrases) are served from memory;
+# the first request streams as usual and fills the cache when it completes
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_TEXT_LENGTH = 512
+
+# Per-thread PCM16 scratch buffer for buffered responses, sized for one
+# minute of audio; longer responses use a temporary array instead
+PCM_SCRATCH_SAMPLES = 24000 * 60
+pcm_scratch = threading.local()
+
+# Per-process request ids and a once-per-second health timestamp
+request_counter = itertools.count()
+process_id = os.getpid()
+timestamp_cache = (0, '')
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for faster request parsing and responses"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def use_orjson(app):
+    """Serialize the app's JSON with orjson when it is installed"""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+
+def configure_torch():
+    """Apply the CPU inference settings; call once before loading the model"""
+    torch.set_default_device('cpu')
+    torch.backends.mkldnn.enabled = True
+    torch.set_num_threads(TORCH_THREADS)
+    torch.set_num_interop_threads(1)
+
+def wav_header(n_samples=None):
+    """Build the 44-byte mono 24 kHz PCM16 WAV header; None leaves the length open for streaming"""
+    if n_samples is None:
+        riff_size = data_size = 0xFFFFFFFF
+    else:
+        data_size = 2 * n_samples
+        riff_size = 36 + data_size
+    return (
+        b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, 24000, 48000, 2, 16)
+        + b'data' + struct.pack('<I', data_size)
+    )
+
+# Streaming WAV header with unknown length fields
+STREAM_WAV_HEADER = wav_header()
+
+def refresh_process_id():
+    global process_id
+    process_id = os.getpid()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=refresh_process_id)
+
+def new_request_id():
+    """Short unique id for download names, without reading /dev/urandom"""
+    return f'{process_id:x}-{next(request_counter):x}'
+
+def current_timestamp():
+    """ISO timestamp of the current second, formatted at most once per second"""
+    global timestamp_cache
+    now = int(time.time())
+    second, timestamp = timestamp_cache
+    if second != now:
+        timestamp = datetime.fromtimestamp(now).isoformat()
+        timestamp_cache = (now, timestamp)
+    return timestamp
+
+def get_g2p_executor():
+    """Return the G2P thread pool, recreating it after a fork"""
+    global g2p_executor, g2p_executor_pid
+    with g2p_executor_lock:
+        if g2p_executor is None or g2p_executor_pid != os.getpid():
+            # One producer task per active job can run at once
+            g2p_executor = ThreadPoolExecutor(max_workers=MAX_BATCH_SIZE, thread_name_prefix='tts-g2p')
+            g2p_executor_pid = os.getpid()
+        return g2p_executor
+
+def prefetch_phonemes(pipeline, text):
+    """Run G2P on the pool up to two chunks ahead, yielding SEGMENT_NOT_READY while none is ready"""
+    g2p = copy.copy(pipeline)
+    g2p.model = None  # Without a model the pipeline only phonemizes
+    chunks = queue.Queue()
+    results = None
+    # Guards the producer state so at most one pool task advances results
+    state_lock = threading.Lock()
+    state = {'running': False, 'done': False}
+    stop = threading.Event()
+    
+    def schedule():
+        # Each pool task phonemizes a single chunk and returns, so a job whose
+        # client stopped reading never holds a pool thread
+        with state_lock:
+            if state['running'] or state['done'] or stop.is_set() or chunks.qsize() >= 2:
+                return
+            state['running'] = True
+        get_g2p_executor().submit(produce)
+    
+    def produce():
+        nonlocal results
+        try:
+            if results is None:
+                results = g2p(text, split_pattern=SENTENCE_SPLIT_PATTERN)
+            # espeak-ng keeps global state, so phonemize one chunk at a time
+            with g2p_lock:
+                result = next(results, None)
+            item = None if result is None else result.phonemes
+        except Exception as e:
+            item = e
+        with state_lock:
+            chunks.put(item)
+            state['running'] = False
+            state['done'] = item is None or isinstance(item, Exception)
+        schedule()
+    
+    schedule()
+    try:
+        while True:
+            try:
+                item = chunks.get(timeout=G2P_POLL_SECONDS)
+            except queue.Empty:
+                # Let the batch worker move on to other jobs rather than wait here
+                yield SEGMENT_NOT_READY
+                continue
+            schedule()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def synthesize_segments(pipeline, text, voice, speed):
+    """Yield float32 audio segments, rendering each phoneme chunk while G2P runs ahead"""
+    pack = pipeline.load_voice(voice)
+    phoneme_chunks = prefetch_phonemes(pipeline, text)
+    try:
+        for ps in phoneme_chunks:
+            if ps is SEGMENT_NOT_READY:
+                yield ps
+                continue
+            # Enter the (thread-local) inference contexts only while the model runs
+            with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=USE_BF16):
+                output = KPipeline.infer(pipeline.model, ps, pack, speed)
+            yield output.audio.float().numpy()
+    finally:
+        phoneme_chunks.close()
+
+class OnnxExportWrapper(torch.nn.Module):
+    """Exposes KModel.forward_with_tokens as forward() for torch.onnx.export"""
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, input_ids, ref_s, speed):
+        return self.model.forward_with_tokens(input_ids, ref_s, speed)
+
+def attach_onnx_runtime(model, voice_pack):
+    """Export the model to ONNX (once) and route its forward pass through ONNX Runtime"""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("  ⚠️ onnxruntime is not installed, staying on PyTorch")
+        return False
+    
+    try:
+        if not os.path.exists(ONNX_MODEL_PATH):
+            print(f"  🔄 Exporting model to {ONNX_MODEL_PATH}...")
+            input_ids = torch.LongTensor([[0, *range(1, 33), 0]])
+            torch.onnx.export(
+                OnnxExportWrapper(model),
+                (input_ids, voice_pack[input_ids.shape[1] - 3], torch.tensor([1.0])),
+                ONNX_MODEL_PATH,
+                opset_version=17,
+                input_names=['input_ids', 'ref_s', 'speed'],
+                output_names=['audio', 'pred_dur'],
+                dynamic_axes={'input_ids': {1: 'tokens'}, 'audio': {0: 'samples'}, 'pred_dur': {0: 'tokens'}}
+            )
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = TORCH_THREADS
+        session = ort.InferenceSession(ONNX_MODEL_PATH, sess_options=options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        print(f"  ⚠️ ONNX Runtime setup failed, staying on PyTorch: {e}")
+        return False
+    
+    # ORT sessions are not fork-safe, so each worker process opens its own
+    sessions = {os.getpid(): session}
+    
+    def get_session():
+        pid = os.getpid()
+        if pid not in sessions:
+            sessions.clear()
+            sessions[pid] = ort.InferenceSession(ONNX_MODEL_PATH, sess_options=options, providers=['CPUExecutionProvider'])
+        return sessions[pid]
+    
+    def forward_with_tokens(input_ids, ref_s, speed):
+        audio, pred_dur = get_session().run(None, {
+            'input_ids': input_ids.numpy(),
+            'ref_s': ref_s.float().numpy(),
+            'speed': np.array([speed], dtype=np.float32)
+        })
+        return torch.from_numpy(audio), torch.from_numpy(pred_dur)
+    
+    # KModel.forward still handles phoneme lookup; only the graph runs in ORT
+    model.forward_with_tokens = forward_with_tokens
+    print("  ✅ Model running on ONNX Runtime")
+    return True
+
+def optimize_pipeline(pipeline, voice):
+    """Move the model to ONNX Runtime or quantize and compile it, then warm it up"""
+    use_onnx = bool(ONNX_MODEL_PATH) and attach_onnx_runtime(pipeline.model, pipeline.load_voice(voice))
+    
+    if USE_INT8 and not use_onnx:
+        print("  🔄 Quantizing Linear/LSTM layers to int8...")
+        pipeline.model = torch.ao.quantization.quantize_dynamic(
+            pipeline.model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8
+        )
+    
+    model = pipeline.model
+    compiled = USE_COMPILE and not use_onnx
+    
+    if compiled:
+        print("  🔄 Compiling model with torch.compile (first run is slow)...")
+        # Token counts vary with every sentence and speed is a Python float, so
+        # trace both symbolically rather than recompiling for each new value
+        if hasattr(torch._dynamo.config, 'specialize_float'):
+            torch._dynamo.config.specialize_float = False
+        model.forward_with_tokens = torch.compile(model.forward_with_tokens, dynamic=True)
+    
+    try:
+        # Drain one synthesis so compilation happens before the first request
+        for _ in synthesize_segments(pipeline, WARMUP_TEXT, voice, 1.0):
+            pass
+    except Exception as e:
+        if not (compiled or use_onnx):
+            raise
+        print(f"  ⚠️ Optimized model failed, falling back to eager PyTorch: {e}")
+        model.__dict__.pop('forward_with_tokens', None)
+        for _ in synthesize_segments(pipeline, WARMUP_TEXT, voice, 1.0):
+            pass
+
+def share_memory(model, *tensors):
+    """Move weights into shared memory when KOKORO_SHARE_MEMORY=1; returns whether they were moved"""
+    if not USE_SHARED_MEMORY:
+        return False
+    try:
+        for tensor in itertools.chain(model.parameters(), model.buffers(), tensors):
+            tensor.share_memory_()
+    except (RuntimeError, OSError) as e:
+        # Tensors already moved stay valid; the rest remain in private memory
+        print(f"  ⚠️ Could not move weights into shared memory, continuing without: {e}")
+        return False
+    return True
+
+class SynthesisJob:
+    """Queued synthesis request whose segments are delivered through an output queue"""
+    
+    def __init__(self, segments):
+        self.segments = segments
+        self.output = queue.Queue()
+        self.cancelled = False
+    
+    def __iter__(self):
+        try:
+            while True:
+                item = self.output.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Client went away (or finished): stop synthesizing for it
+            self.cancelled = True
+
+class BatchWorker:
+    """Background thread that interleaves segment synthesis across concurrent requests"""
+    
+    def __init__(self, max_batch_size):
+        self.pending = queue.Queue()
+        self.max_batch_size = max_batch_size
+        self.active_jobs = 0
+        self.held_jobs = 0
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def submit(self, segments):
+        """Queue a segment generator and return a job to iterate for its audio"""
+        self.ensure_running()
+        job = SynthesisJob(segments)
+        self.pending.put(job)
+        return job
+    
+    def ensure_running(self):
+        # Threads do not survive fork, so start lazily in the serving process
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='tts-batch-worker', daemon=True)
+                self.thread.start()
+    
+    def status(self):
+        return {
+            'queue_depth': self.pending.qsize(),
+            'active_jobs': self.active_jobs,
+            'held_jobs': self.held_jobs,
+            'max_batch_size': self.max_batch_size
+        }
+    
+    def admit(self, batch, timeout):
+        """Move pending jobs into the batch, waiting up to timeout seconds for more"""
+        deadline = time.monotonic() + timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.pending.get(timeout=remaining))
+                else:
+                    batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                return
+    
+    def run(self):
+        while True:
+            batch = []
+            # Jobs paused for a slow reader wait here without taking a batch slot
+            held = []
+            try:
+                self.schedule(batch, held)
+            except Exception as e:
+                # Fail every job this loop was responsible for rather than leave
+                # its client waiting forever, then start scheduling afresh
+                print(f"❌ TTS worker failed, restarting: {e}")
+                self.fail_jobs(batch + held, e)
+    
+    def fail_jobs(self, jobs, error):
+        """Deliver error to the given jobs and everything still pending"""
+        while True:
+            try:
+                jobs.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        for job in jobs:
+            job.output.put(error)
+            try:
+                job.segments.close()
+            except Exception:
+                pass
+        self.active_jobs = 0
+        self.held_jobs = 0
+    
+    def schedule(self, batch, held):
+        """Advance the jobs in batch round-robin, forever; held and batch are updated in place"""
+        progressed = True
+        while True:
+            # Resume held jobs once their client has drained some audio (or left)
+            for job in list(held):
+                if job.cancelled or job.output.qsize() < MAX_INFLIGHT_SEGMENTS:
+                    held.remove(job)
+                    batch.append(job)
+            
+            if batch or held:
+                # If every job is waiting on its client, pause briefly instead of spinning
+                self.admit(batch, 0 if progressed else 0.01)
+            else:
+                # Idle: block for the first job, then take whatever else is already queued.
+                # Jobs are interleaved, not batched into one forward pass, so waiting
+                # for more would only delay this one
+                batch.append(self.pending.get())
+                self.admit(batch, 0)
+            self.active_jobs = len(batch)
+            
+            # Advance every job by one segment so all requests make progress
+            progressed = False
+            for job in list(batch):
+                if job.cancelled:
+                    job.segments.close()
+                    batch.remove(job)
+                    continue
+                if job.output.qsize() >= MAX_INFLIGHT_SEGMENTS:
+                    # Slow reader: park its synthesis until it drains some audio
+                    batch.remove(job)
+                    held.append(job)
+                    continue
+                try:
+                    segment = next(job.segments, None)
+                except Exception as e:
+                    print(f"❌ Error in TTS worker: {e}")
+                    job.output.put(e)
+                    batch.remove(job)
+                    progressed = True
+                    continue
+                if segment is SEGMENT_NOT_READY:
+                    # Still phonemizing: try again next round
+                    continue
+                progressed = True
+                job.output.put(segment)
+                if segment is None:
+                    batch.remove(job)
+            self.active_jobs = len(batch)
+            self.held_jobs = len(held)
+
+batch_worker = BatchWorker(MAX_BATCH_SIZE)
+
+class WavCache:
+    """Thread-safe LRU cache of complete WAV files for short texts"""
+    
+    def __init__(self, max_entries):
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            wav = self.entries.get(key)
+            if wav is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return wav
+    
+    def put(self, key, wav):
+        with self.lock:
+            self.entries[key] = wav
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'max_size': self.max_entries
+        }
+
+wav_cache = WavCache(CACHE_MAX_ENTRIES)
+
+def to_pcm16(audio, out=None):
+    """Convert float32 audio in place to [-1, 1] and return it as little-endian PCM16, in out if given"""
+    np.clip(audio, -1.0, 1.0, out=audio)
+    np.multiply(audio, 32767.0, out=audio)
+    np.rint(audio, out=audio)  # Round to nearest; the integer cast truncates toward zero
+    if out is None:
+        return audio.astype('<i2')
+    out[:] = audio
+    return out
+
+def get_pcm_scratch(n_samples):
+    """Return this thread's PCM16 scratch buffer, or a one-off array for longer audio"""
+    if n_samples > PCM_SCRATCH_SAMPLES:
+        # Rare long responses get their own array so idle threads don't pin the memory
+        return np.empty(n_samples, dtype='<i2')
+    buffer = getattr(pcm_scratch, 'buffer', None)
+    if buffer is None:
+        buffer = np.empty(PCM_SCRATCH_SAMPLES, dtype='<i2')
+        buffer.fill(0)  # Fault the pages in once, not on every request
+        pcm_scratch.buffer = buffer
+    return buffer
+
+def render_wav(pipeline, text, voice, speed):
+    """Synthesize text through the batch worker and encode it as a WAV file"""
+    audio_segments = list(batch_worker.submit(synthesize_segments(pipeline, text, voice, speed)))
+    
+    if not audio_segments:
+        raise ValueError('No audio generated')
+    
+    # Convert each segment straight into the reused scratch buffer
+    total = sum(segment.shape[0] for segment in audio_segments)
+    pcm16 = get_pcm_scratch(total)
+    offset = 0
+    for segment in audio_segments:
+        n = segment.shape[0]
+        to_pcm16(segment, out=pcm16[offset:offset + n])
+        offset += n
+    return b''.join((wav_header(total), memoryview(pcm16[:total])))
+
+def generate_wav_stream(pipeline, text, voice, speed, cache_key=None):
+    """Start synthesis and return a WAV byte stream, raising voice or model errors before any byte is sent"""
+    pack = pipeline.load_voice(voice)
+    segments = iter(batch_worker.submit(synthesize_segments(pipeline, text, pack, speed)))
+    first = next(segments, None)
+    if first is None:
+        raise ValueError('No audio generated')
+    return stream_wav_frames(first, segments, cache_key)
+
+def stream_wav_frames(first, segments, cache_key=None):
+    """Yield a WAV header followed by PCM16 frames, caching the full WAV under cache_key once complete"""
+    frames = [] if cache_key is not None else None
+    yield STREAM_WAV_HEADER
+    try:
+        for audio in itertools.chain((first,), segments):
+            frame = to_pcm16(audio).tobytes()
+            if frames is not None:
+                frames.append(frame)
+            yield frame
+    except Exception as e:
+        print(f"❌ Error while streaming TTS: {e}")
+        raise
+    if frames is not None:
+        # Only a fully sent stream is cached, with its real length in the header
+        pcm = b''.join(frames)
+        wav_cache.put(cache_key, wav_header(len(pcm) // 2) + pcm)
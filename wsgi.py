@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+WSGI entry point for serving Kokoro TTS under gunicorn
+Run with a single process and a thread per in-flight request:
+
+    gunicorn -w 1 --threads 8 -k gthread -b 0.0.0.0:5001 wsgi:application
+
+To run several worker processes, add --preload: the model is then loaded
+once before forking. Extra accents load inline rather than on a thread,
+so no lock is held across the fork, and each worker recreates the G2P pool
+and its own ONNX Runtime session (KOKORO_ONNX) on first use. Set
+KOKORO_SHARE_MEMORY=1 to keep the weights in /dev/shm, which must have
+room for the whole model.
+
+Set KOKORO_SERVER=multi to serve the multi-accent server instead of the
+single-voice one.
+"""
+
+import os
+
+if os.environ.get('KOKORO_SERVER', 'single') == 'multi':
+    from kakora_server_lock import app, initialize_pipelines
+    initialize_pipelines(background=False)
+else:
+    from app import app, initialize_pipeline
+    if not initialize_pipeline():
+        raise RuntimeError('Failed to initialize Kokoro pipeline')
+
+application = app